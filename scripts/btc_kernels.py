@@ -0,0 +1,56 @@
+"""
+Kernels numériques BTC Oracle
+=============================
+
+Fonctions compilées avec Numba utilisées par le pipeline ETL (etl_btc.py).
+Elles travaillent directement sur des tableaux numpy float64.
+
+Les kernels publics déclarent leurs signatures: ils sont compilés dès
+l'import (puis relus depuis le cache disque de Numba) plutôt qu'au premier
+appel. Les entrées sont typées en lecture seule: elles acceptent ainsi aussi
+bien les tableaux numpy ordinaires que les vues non modifiables retournées
+par pandas (copy-on-write).
+"""
+
+import numpy as np
+from numba import njit, types
+
+_f8_1d = types.Array(types.float64, 1, 'C')
+_f8_1d_in = types.Array(types.float64, 1, 'A', readonly=True)
+
+
+@njit(inline='always')
+def _rolling_mean(a, w):
+    n = a.size
+    out = np.full(n, np.nan)
+    s = 0.0
+    for i in range(n):
+        s += a[i]
+        if i >= w:
+            s -= a[i - w]
+        if i >= w - 1:
+            out[i] = s / w
+    return out
+
+
+@njit(_f8_1d(_f8_1d_in, types.int64), cache=True)
+def rolling_mean(a: np.ndarray, w: int) -> np.ndarray:
+    """
+    Moyenne mobile sur une fenêtre de w valeurs, en un seul passage O(N).
+
+    Maintient une somme glissante (on ajoute la nouvelle valeur et on retire
+    celle qui sort de la fenêtre) au lieu de re-sommer toute la fenêtre.
+    Les w-1 premières valeurs valent NaN, comme pandas.rolling(w).mean().
+    """
+    return _rolling_mean(a, w)
+
+
+@njit(_f8_1d(_f8_1d_in), cache=True)
+def rolling_mean_7(a: np.ndarray) -> np.ndarray:
+    """
+    Moyenne mobile 7 jours (feature ma_7).
+
+    Même calcul que rolling_mean(a, 7), mais la fenêtre est une constante de
+    compilation: le kernel inliné est spécialisé pour w = 7.
+    """
+    return _rolling_mean(a, 7)
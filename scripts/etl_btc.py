@@ -13,7 +13,7 @@ Usage:
     python etl_btc.py
 
 Prérequis:
-    pip install yfinance pandas scikit-learn supabase python-dotenv
+    pip install yfinance pandas numpy numba supabase python-dotenv
 
 Variables d'environnement (.env):
     SUPABASE_URL=https://xxx.supabase.co
@@ -22,16 +22,23 @@ Variables d'environnement (.env):
 
 import os
 import sys
-from datetime import datetime, timedelta
-from typing import Optional
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
 
 import numpy as np
 import pandas as pd
-import yfinance as yf
 from dotenv import load_dotenv
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
-from supabase import create_client, Client
+
+from btc_kernels import rolling_mean_7
+
+# yfinance et supabase sont lourds à importer: ils sont chargés dans les
+# fonctions qui les utilisent pour accélérer le démarrage (et les tests)
+if TYPE_CHECKING:
+    from supabase import Client
 
 # Charger les variables d'environnement
 load_dotenv()
@@ -44,50 +51,170 @@ SYMBOL = "BTC-USD"
 LOOKBACK_DAYS = 60  # Jours d'historique à récupérer
 TRAINING_WINDOW = 30  # Jours utilisés pour l'entraînement
 MODEL_VERSION = "linear_v1"
+PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close']  # Colonnes de prix (float64)
+
+# Nouvelles tentatives sur les erreurs transitoires de Yahoo (429/5xx): la
+# session curl_cffi par défaut de yfinance est conservée (empreinte navigateur)
+FETCH_RETRIES = 3  # Tentatives max pour le téléchargement
+FETCH_RETRY_DELAY_SECONDS = 2.0  # Délai de base, multiplié par le n° de tentative
+
+# Cache disque des données yfinance (évite de re-télécharger lors des relances)
+CACHE_DIR = Path(tempfile.gettempdir()) / "btc_cache"
+CACHE_TTL_SECONDS = 3600  # Durée de validité d'une entrée du cache
+
+# Nombre de décimales conservées pour chaque métrique
+METRICS_DECIMALS = {
+    'mae': 2,
+    'rmse': 2,
+    'r2': 4,
+    'coefficient': 4,
+    'intercept': 2,
+    'std_error': 2,
+}
+
+# Upload
+UPSERT_BATCH_SIZE = 1000  # Lignes max par requête upsert
+UPLOAD_CONCURRENCY = 4  # Requêtes upsert exécutées en parallèle (si plusieurs lots)
 
 # Supabase
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY")  # Utiliser la service_role key!
 
 
-def get_supabase_client() -> Optional[Client]:
+def get_supabase_client() -> Optional["Client"]:
     """Initialise le client Supabase avec validation."""
     if not SUPABASE_URL or not SUPABASE_KEY:
         print("ERREUR: Variables SUPABASE_URL et SUPABASE_SERVICE_KEY requises")
         print("Créez un fichier .env avec ces variables")
         return None
+
+    from supabase import create_client
     return create_client(SUPABASE_URL, SUPABASE_KEY)
 
 
+def _read_cache(path: Path) -> Optional[pd.DataFrame]:
+    """
+    Retourne les données en cache si le fichier existe et est encore frais.
+
+    Un fichier illisible (vide, corrompu) est traité comme une absence de
+    cache: les données sont alors re-téléchargées.
+    """
+    try:
+        if time.time() - path.stat().st_mtime > CACHE_TTL_SECONDS:
+            return None
+        df = pd.read_csv(path, index_col='Date', parse_dates=['Date'])
+        missing = {*PRICE_COLUMNS, 'Volume'} - set(df.columns)
+        if missing:
+            raise ValueError(f"colonnes manquantes: {sorted(missing)}")
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        # ValueError couvre aussi EmptyDataError et ParserError de pandas
+        print(f"  AVERTISSEMENT: cache illisible ignoré ({e})")
+        return None
+
+    print(f"  Données lues depuis le cache: {path}")
+    return df
+
+
+def _write_cache(path: Path, df: pd.DataFrame) -> None:
+    """
+    Écrit les données brutes yfinance dans le cache (échec non bloquant).
+
+    L'écriture passe par un fichier temporaire renommé ensuite (os.replace,
+    atomique): une écriture interrompue ne laisse jamais de fichier partiel
+    à l'emplacement lu par _read_cache.
+    """
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        df.to_csv(tmp_path)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"  AVERTISSEMENT: écriture du cache impossible ({e})")
+        try:
+            tmp_path.unlink(missing_ok=True)
+        except OSError:
+            pass
+
+
+def _download_history(start_date: datetime, end_date: datetime) -> Optional[pd.DataFrame]:
+    """
+    Télécharge l'historique via yf.download, avec FETCH_RETRIES tentatives.
+
+    yf.download masque la plupart des erreurs réseau (résultat vide): un
+    résultat vide est donc réessayé comme une exception. Après la dernière
+    tentative, l'exception est propagée ou le résultat (vide) retourné.
+    """
+    import yfinance as yf
+
+    for attempt in range(1, FETCH_RETRIES + 1):
+        try:
+            # yf.download: chemin plus léger que Ticker.history pour un seul
+            # symbole (pas de barre de progression ni de threads)
+            df = yf.download(
+                SYMBOL,
+                start=start_date,
+                end=end_date,
+                progress=False,
+                threads=False,
+                auto_adjust=True,
+                multi_level_index=False,
+            )
+        except Exception as e:
+            if attempt == FETCH_RETRIES:
+                raise
+            print(f"  Tentative {attempt}/{FETCH_RETRIES} échouée ({e}), nouvel essai...")
+        else:
+            if (df is not None and not df.empty) or attempt == FETCH_RETRIES:
+                return df
+            print(f"  Tentative {attempt}/{FETCH_RETRIES}: aucune donnée, nouvel essai...")
+
+        time.sleep(FETCH_RETRY_DELAY_SECONDS * attempt)
+
+
 def fetch_btc_data(days: int = LOOKBACK_DAYS) -> pd.DataFrame:
     """
     Récupère les données historiques BTC-USD via yfinance.
 
+    Les données brutes sont mises en cache sur disque (CACHE_DIR) pendant
+    CACHE_TTL_SECONDS pour éviter les appels réseau lors des relances.
+
     Returns:
-        DataFrame avec colonnes: Date, Open, High, Low, Close, Volume
+        DataFrame avec colonnes: Date (datetime64), Open, High, Low, Close, Volume
     """
     print(f"Récupération des {days} derniers jours de données {SYMBOL}...")
 
     end_date = datetime.now()
     start_date = end_date - timedelta(days=days)
 
-    ticker = yf.Ticker(SYMBOL)
-    df = ticker.history(start=start_date, end=end_date)
+    cache_path = CACHE_DIR / f"{SYMBOL}_{days}_{date.today()}.csv"
+    df = _read_cache(cache_path)
+
+    if df is None:
+        df = _download_history(start_date, end_date)
+
+        if df is None or df.empty:
+            raise ValueError(f"Aucune donnée récupérée pour {SYMBOL}")
 
-    if df.empty:
-        raise ValueError(f"Aucune donnée récupérée pour {SYMBOL}")
+        _write_cache(cache_path, df)
 
     # Nettoyer et formater
     df = df.reset_index()
-    df['Date'] = pd.to_datetime(df['Date']).dt.date
-    df = df[['Date', 'Open', 'High', 'Low', 'Close', 'Volume']]
-
-    # Supprimer les doublons et valeurs manquantes
-    df = df.drop_duplicates(subset=['Date'])
-    df = df.dropna()
+    # Date conservée en datetime64 (sans fuseau, à minuit) pour tout le pipeline
+    df['Date'] = df['Date'].dt.tz_localize(None).dt.normalize()
+    # Prix convertis une seule fois en float64: les to_numpy(np.float64) en
+    # aval sont alors sans copie et tolist() produit directement des float
+    df = df[['Date', *PRICE_COLUMNS, 'Volume']].astype(
+        {column: np.float64 for column in PRICE_COLUMNS}
+    )
+
+    # Supprimer les doublons et valeurs manquantes (un seul masque, une seule copie)
+    complete = df[[*PRICE_COLUMNS, 'Volume']].notna().all(axis=1)
+    df = df.loc[~df['Date'].duplicated() & complete].reset_index(drop=True)
 
     print(f"  {len(df)} jours de données récupérés")
-    print(f"  Période: {df['Date'].min()} -> {df['Date'].max()}")
+    print(f"  Période: {df['Date'].min():%Y-%m-%d} -> {df['Date'].max():%Y-%m-%d}")
 
     return df
 
@@ -104,22 +231,26 @@ def prepare_features(df: pd.DataFrame) -> pd.DataFrame:
     - volatility: (High - Low) / Close
     - ma_7: Moyenne mobile 7 jours
     """
-    df = df.copy()
-
-    # Features temporelles
-    df['day_of_week'] = pd.to_datetime(df['Date']).dt.dayofweek
-    df['day_index'] = range(len(df))
-
-    # Features de prix
-    df['prev_close'] = df['Close'].shift(1)
-    df['price_change'] = df['Close'].pct_change() * 100
-    df['volatility'] = (df['High'] - df['Low']) / df['Close']
-
-    # Moyennes mobiles
-    df['ma_7'] = df['Close'].rolling(window=7).mean()
-
-    # Supprimer les lignes avec NaN (dues aux calculs de lag)
-    df = df.dropna()
+    close = df['Close'].to_numpy(dtype=np.float64)
+    high = df['High'].to_numpy(dtype=np.float64)
+    low = df['Low'].to_numpy(dtype=np.float64)
+
+    # Features de prix, calculées directement sur les tableaux numpy
+    prev_close = np.concatenate(([np.nan], close[:-1]))
+    price_change = (close / prev_close - 1.0) * 100.0
+    volatility = (high - low) / close
+
+    # Toutes les colonnes sont ajoutées en une seule fois; assign retourne un
+    # nouveau DataFrame (pas besoin de copier l'entrée). Les lignes avec NaN
+    # (dues aux calculs de lag) sont supprimées.
+    df = df.assign(
+        day_of_week=df['Date'].dt.dayofweek.to_numpy(),
+        day_index=np.arange(len(df)),
+        prev_close=prev_close,
+        price_change=price_change,
+        volatility=volatility,
+        ma_7=rolling_mean_7(close),
+    ).dropna()
 
     return df
 
@@ -131,56 +262,74 @@ def train_model(df: pd.DataFrame) -> tuple:
     Pour cette v1 simple, on utilise uniquement day_index comme feature
     (tendance linéaire). Cela permet de prédire la "continuation de tendance".
 
+    La régression est résolue en forme fermée (pas de scikit-learn): le
+    "modèle" retourné est le couple (pente, ordonnée à l'origine).
+
     Returns:
         (model, metrics_dict, prediction, confidence, lower_bound, upper_bound)
     """
     print(f"\nEntraînement sur les {TRAINING_WINDOW} derniers jours...")
 
-    # Utiliser les N derniers jours
-    train_df = df.tail(TRAINING_WINDOW).copy()
-
-    # Feature simple: index du jour (capture la tendance)
-    # On réindexe pour que le modèle apprenne la tendance récente
-    train_df['train_index'] = range(len(train_df))
-
-    X = train_df[['train_index']].values
-    y = train_df['Close'].values
-
-    # Entraînement
-    model = LinearRegression()
-    model.fit(X, y)
-
-    # Prédictions sur les données d'entraînement
-    y_pred_train = model.predict(X)
-
-    # Métriques
-    mae = mean_absolute_error(y, y_pred_train)
-    rmse = np.sqrt(mean_squared_error(y, y_pred_train))
-    r2 = r2_score(y, y_pred_train)
+    # Utiliser les N derniers jours (vue sur la colonne, sans copie du DataFrame)
+    y = df['Close'].iloc[-TRAINING_WINDOW:].to_numpy(dtype=np.float64)
+
+    # Feature simple: index du jour 0..n-1 (capture la tendance récente)
+    n = y.size
+    x_mean = (n - 1) / 2
+
+    # Moindres carrés ordinaires en forme fermée (une seule feature), sur des
+    # variables centrées: évite de soustraire des sommes de l'ordre de 1e11
+    # (Σy², (Σy)²/n) qui ne diffèrent que de quelques millions.
+    # Pour x = 0..n-1, Σ(x − x̄)² = n(n² − 1)/12 est connu analytiquement.
+    y_mean = y.mean()
+    xc = np.arange(n, dtype=np.float64) - x_mean
+    yc = y - y_mean
+    sxx = n * (n * n - 1) / 12
+    sxy, ss_tot = xc @ yc, yc @ yc
+    slope = sxy / sxx
+    intercept = y_mean - slope * x_mean
+    model = (slope, intercept)
+
+    # Somme des carrés des résidus via les statistiques suffisantes: à
+    # l'optimum OLS, SSR = Syy − b·Sxy (sommes centrées, b = pente).
+    # Clampée à 0 contre les erreurs d'arrondi sur un ajustement parfait.
+    ssr = max(ss_tot - slope * sxy, 0.0)
+
+    # Métriques: un seul passage sur les résidus (pour la MAE), le reste
+    # découle de SSR
+    mae = np.abs(yc - slope * xc).mean()
+    mse = ssr / n
+    rmse = np.sqrt(mse)
+    # Prix constants: ajustement parfait, R² = 1 (comme sklearn.r2_score)
+    r2 = 1 - ssr / ss_tot if ss_tot > 0 else 1.0
 
     # Prédiction pour J+1
-    next_index = np.array([[TRAINING_WINDOW]])
-    prediction = model.predict(next_index)[0]
+    prediction = intercept + slope * n
 
     # Calcul du score de confiance basé sur R²
     confidence = max(0, min(1, r2))  # Clamp entre 0 et 1
 
     # Calcul de l'intervalle de confiance 95%
-    # Basé sur l'écart-type des résidus
-    residuals = y - y_pred_train
-    std_error = np.std(residuals)
+    # Basé sur l'écart-type des résidus (de moyenne nulle en OLS: égal au RMSE)
+    std_error = rmse
     # Intervalle 95% : ±1.96 * écart-type
     lower_bound = prediction - 1.96 * std_error
     upper_bound = prediction + 1.96 * std_error
 
-    metrics = {
-        'mae': round(mae, 2),
-        'rmse': round(rmse, 2),
-        'r2': round(r2, 4),
-        'coefficient': round(model.coef_[0], 4),
-        'intercept': round(model.intercept_, 2),
-        'std_error': round(std_error, 2)
+    # Arrondi en une seule opération numpy (np.round n'accepte qu'un nombre
+    # de décimales scalaire, d'où le passage par un facteur d'échelle)
+    raw_metrics = {
+        'mae': mae,
+        'rmse': rmse,
+        'r2': r2,
+        'coefficient': slope,
+        'intercept': intercept,
+        'std_error': std_error,
     }
+    keys = list(METRICS_DECIMALS)
+    values = np.array([raw_metrics[key] for key in keys])
+    scale = 10.0 ** np.array([METRICS_DECIMALS[key] for key in keys])
+    metrics = dict(zip(keys, (np.round(values * scale) / scale).tolist()))
 
     print(f"  Coefficient (pente): {metrics['coefficient']} $/jour")
     print(f"  MAE: ${metrics['mae']}")
@@ -193,8 +342,27 @@ def train_model(df: pd.DataFrame) -> tuple:
     return model, metrics, prediction, confidence, lower_bound, upper_bound
 
 
+def _fetch_stored_prices(client: "Client", since: str) -> dict:
+    """
+    Retourne les prix réels déjà en base, indexés par date (YYYY-MM-DD).
+
+    Les lignes de prédiction (actual_price NULL) ne comptent pas: leur prix
+    réel doit encore être écrit quand la journée est connue.
+    """
+    response = (
+        client.table('crypto_metrics')
+        .select('date,actual_price')
+        .eq('symbol', SYMBOL)
+        .eq('model_version', MODEL_VERSION)
+        .gte('date', since)
+        .not_.is_('actual_price', 'null')
+        .execute()
+    )
+    return {row['date']: float(row['actual_price']) for row in response.data}
+
+
 def upload_to_supabase(
-    client: Client,
+    client: "Client",
     df: pd.DataFrame,
     prediction: float,
     confidence: float,
@@ -205,22 +373,30 @@ def upload_to_supabase(
     Upload les données historiques et la prédiction vers Supabase.
 
     Utilise upsert pour éviter les doublons (basé sur date+symbol+model_version).
+    Les jours historiques déjà en base avec le même prix (au centime) ne sont
+    pas renvoyés.
+    Historique et prédiction sont envoyés dans la même requête (par lots de
+    UPSERT_BATCH_SIZE lignes au-delà).
     """
     print("\nUpload vers Supabase...")
 
     # Préparer les données historiques
-    historical_records = []
-    for _, row in df.iterrows():
-        historical_records.append({
-            'date': str(row['Date']),
+    # Conversion vectorisée des colonnes (évite iterrows et un Series par ligne)
+    dates = df['Date'].dt.strftime('%Y-%m-%d').tolist()
+    closes = np.round(df['Close'].to_numpy(dtype=np.float64), 2).tolist()
+    historical_records = [
+        {
+            'date': date,
             'symbol': SYMBOL,
-            'actual_price': float(row['Close']),
+            'actual_price': close,
             'predicted_price': None,  # Pas de prédiction pour l'historique
             'model_version': MODEL_VERSION,
             'confidence_score': None,
             'prediction_lower_bound': None,
             'prediction_upper_bound': None
-        })
+        }
+        for date, close in zip(dates, closes)
+    ]
 
     # Ajouter la prédiction pour demain
     tomorrow = datetime.now().date() + timedelta(days=1)
@@ -236,23 +412,44 @@ def upload_to_supabase(
     }
 
     try:
-        # Upsert des données historiques (par lots de 100)
-        batch_size = 100
-        for i in range(0, len(historical_records), batch_size):
-            batch = historical_records[i:i + batch_size]
+        # Ne renvoyer que les jours absents de la base ou dont le prix a
+        # changé. Un run écrit la barre (incomplète) du jour en cours: sa
+        # clôture définitive, différente, est renvoyée au run suivant.
+        if historical_records:
+            stored_prices = _fetch_stored_prices(client, since=min(dates))
+            new_records = [
+                record for record in historical_records
+                if record['date'] not in stored_prices
+                or abs(stored_prices[record['date']] - record['actual_price']) >= 0.005
+            ]
+            skipped = len(historical_records) - len(new_records)
+            if skipped:
+                print(f"  {skipped} jours déjà à jour ignorés")
+            historical_records = new_records
+
+        # Historique et prédiction partagent la même clé (date, symbol,
+        # model_version): ils sont envoyés ensemble, en un seul upsert tant
+        # que tout tient dans un lot.
+        records = historical_records + [prediction_record]
+        queries = [
             client.table('crypto_metrics').upsert(
-                batch,
+                records[i:i + UPSERT_BATCH_SIZE],
                 on_conflict='date,symbol,model_version'
-            ).execute()
+            )
+            for i in range(0, len(records), UPSERT_BATCH_SIZE)
+        ]
+
+        if len(queries) == 1:
+            queries[0].execute()
+        else:
+            # Gros volumes: seules les exécutions HTTP sont parallélisées,
+            # l'upload étant limité par la latence réseau
+            with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+                futures = [executor.submit(query.execute) for query in queries]
+                for future in futures:
+                    future.result()  # Propage la première erreur rencontrée
 
         print(f"  {len(historical_records)} enregistrements historiques uploadés")
-
-        # Upsert de la prédiction
-        client.table('crypto_metrics').upsert(
-            prediction_record,
-            on_conflict='date,symbol,model_version'
-        ).execute()
-
         print(f"  Prédiction pour {tomorrow} uploadée")
 
         return True
@@ -0,0 +1,79 @@
+"""
+Tests pour les kernels Numba de BTC Oracle.
+"""
+
+import pytest
+import pandas as pd
+import numpy as np
+
+# Import des fonctions à tester
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from btc_kernels import rolling_mean, rolling_mean_7
+
+
+# ============================================
+# Tests: rolling_mean
+# ============================================
+
+class TestRollingMean:
+    """Tests pour le kernel rolling_mean."""
+
+    def test_matches_pandas_rolling(self):
+        """Vérifie que le résultat est identique à pandas.rolling().mean()."""
+        np.random.seed(42)
+        a = 40000 + np.cumsum(np.random.randn(60) * 500)
+
+        result = rolling_mean(a, 7)
+        expected = pd.Series(a).rolling(window=7).mean().to_numpy()
+
+        np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+    def test_leading_values_are_nan(self):
+        """Vérifie que les w-1 premières valeurs sont NaN."""
+        result = rolling_mean(np.arange(10, dtype=np.float64), 3)
+
+        assert np.isnan(result[:2]).all()
+        assert result[2] == pytest.approx(1.0)
+        assert result[-1] == pytest.approx(8.0)
+
+    def test_window_larger_than_input(self):
+        """Vérifie qu'une fenêtre plus longue que l'entrée ne donne que des NaN."""
+        result = rolling_mean(np.ones(5), 7)
+
+        assert result.shape == (5,)
+        assert np.isnan(result).all()
+
+
+# ============================================
+# Tests: rolling_mean_7
+# ============================================
+
+class TestRollingMean7:
+    """Tests pour le kernel spécialisé rolling_mean_7."""
+
+    def test_matches_generic_kernel(self):
+        """Vérifie que la version spécialisée égale rolling_mean(a, 7)."""
+        np.random.seed(0)
+        a = 40000 + np.cumsum(np.random.randn(60) * 500)
+
+        np.testing.assert_array_equal(rolling_mean_7(a), rolling_mean(a, 7))
+
+    def test_accepts_column_view(self):
+        """Vérifie le fonctionnement sur une vue non contiguë (colonne d'un tableau 2D)."""
+        a = np.arange(40, dtype=np.float64).reshape(20, 2)[:, 0]
+
+        result = rolling_mean_7(a)
+
+        assert result[-1] == pytest.approx(a[-7:].mean())
+
+    def test_accepts_readonly_array(self):
+        """Vérifie le fonctionnement sur un tableau en lecture seule (vue pandas)."""
+        a = np.arange(20, dtype=np.float64)
+        a.setflags(write=False)
+
+        result = rolling_mean_7(a)
+
+        assert result[-1] == pytest.approx(a[-7:].mean())
@@ -5,6 +5,9 @@ Ces tests utilisent des mocks pour éviter les appels API réels
 (yfinance, Supabase).
 """
 
+import time
+import warnings
+
 import pytest
 import pandas as pd
 import numpy as np
@@ -16,13 +19,17 @@ import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import etl_btc
 from etl_btc import (
     fetch_btc_data,
     prepare_features,
     train_model,
     upload_to_supabase,
     get_supabase_client,
+    SYMBOL,
     TRAINING_WINDOW,
+    CACHE_TTL_SECONDS,
+    FETCH_RETRIES,
 )
 
 
@@ -40,7 +47,7 @@ def sample_btc_data():
     prices = base_price + np.cumsum(np.random.randn(40) * 500)
 
     df = pd.DataFrame({
-        'Date': dates.date,
+        'Date': dates.normalize(),
         'Open': prices * 0.99,
         'High': prices * 1.02,
         'Low': prices * 0.98,
@@ -56,6 +63,34 @@ def prepared_data(sample_btc_data):
     return prepare_features(sample_btc_data)
 
 
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    """Redirige le cache disque yfinance vers un dossier temporaire."""
+    monkeypatch.setattr('etl_btc.CACHE_DIR', tmp_path / 'btc_cache')
+    return tmp_path / 'btc_cache'
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    """Supprime l'attente entre deux tentatives de téléchargement."""
+    monkeypatch.setattr('etl_btc.FETCH_RETRY_DELAY_SECONDS', 0)
+
+
+@pytest.fixture
+def mock_history():
+    """Réponse yf.download simulée (DatetimeIndex nommé 'Date')."""
+    dates = pd.date_range(end=datetime.now(), periods=30, tz='UTC')
+    history = pd.DataFrame({
+        'Open': [40000.0] * 30,
+        'High': [41000.0] * 30,
+        'Low': [39000.0] * 30,
+        'Close': [40500.0] * 30,
+        'Volume': [1000000] * 30
+    }, index=dates)
+    history.index.name = 'Date'
+    return history
+
+
 # ============================================
 # Tests: fetch_btc_data
 # ============================================
@@ -63,10 +98,10 @@ def prepared_data(sample_btc_data):
 class TestFetchBtcData:
     """Tests pour la fonction fetch_btc_data."""
 
-    @patch('etl_btc.yf.Ticker')
-    def test_fetch_returns_dataframe(self, mock_ticker):
+    @patch('yfinance.download')
+    def test_fetch_returns_dataframe(self, mock_download):
         """Vérifie que fetch retourne un DataFrame avec les bonnes colonnes."""
-        # Setup mock - yfinance returns a DataFrame with DatetimeIndex
+        # Setup mock - yf.download returns a DataFrame with DatetimeIndex
         dates = pd.date_range(end=datetime.now(), periods=30)
         mock_history = pd.DataFrame({
             'Open': [40000] * 30,
@@ -76,7 +111,7 @@ class TestFetchBtcData:
             'Volume': [1000000] * 30
         }, index=dates)
         mock_history.index.name = 'Date'
-        mock_ticker.return_value.history.return_value = mock_history
+        mock_download.return_value = mock_history
 
         # Execute
         result = fetch_btc_data(days=30)
@@ -84,17 +119,140 @@ class TestFetchBtcData:
         # Assert
         assert isinstance(result, pd.DataFrame)
         assert 'Date' in result.columns
+        assert pd.api.types.is_datetime64_dtype(result['Date'])
+        for column in ['Open', 'High', 'Low', 'Close']:
+            assert result[column].dtype == np.float64
         assert 'Close' in result.columns
         assert len(result) > 0
 
-    @patch('etl_btc.yf.Ticker')
-    def test_fetch_raises_on_empty_data(self, mock_ticker):
+    @patch('yfinance.download')
+    def test_fetch_download_arguments(self, mock_download, mock_history):
+        """Vérifie l'appel à yf.download (sans progression, session yfinance par défaut)."""
+        mock_download.return_value = mock_history
+
+        fetch_btc_data(days=30)
+
+        mock_download.assert_called_once()
+        assert mock_download.call_args[0][0] == SYMBOL
+        assert mock_download.call_args[1]['progress'] is False
+        assert 'session' not in mock_download.call_args[1]
+
+    @patch('yfinance.download')
+    def test_fetch_retries_transient_failures(self, mock_download, mock_history):
+        """Vérifie qu'une erreur puis un résultat vide sont réessayés."""
+        mock_download.side_effect = [Exception("429 Too Many Requests"), pd.DataFrame(), mock_history]
+
+        result = fetch_btc_data(days=30)
+
+        assert mock_download.call_count == 3
+        assert len(result) == 30
+
+    @patch('yfinance.download')
+    def test_fetch_raises_after_last_failure(self, mock_download):
+        """Vérifie que l'erreur est propagée après FETCH_RETRIES tentatives."""
+        mock_download.side_effect = Exception("503 Service Unavailable")
+
+        with pytest.raises(Exception, match="503"):
+            fetch_btc_data(days=30)
+
+        assert mock_download.call_count == FETCH_RETRIES
+
+    @patch('yfinance.download')
+    def test_fetch_raises_on_empty_data(self, mock_download):
         """Vérifie que fetch lève une erreur si pas de données."""
-        mock_ticker.return_value.history.return_value = pd.DataFrame()
+        mock_download.return_value = pd.DataFrame()
 
         with pytest.raises(ValueError, match="Aucune donnée récupérée"):
             fetch_btc_data()
 
+    @patch('yfinance.download')
+    def test_fetch_raises_when_download_returns_none(self, mock_download):
+        """Vérifie que fetch lève une erreur si yf.download ne retourne rien."""
+        mock_download.return_value = None
+
+        with pytest.raises(ValueError, match="Aucune donnée récupérée"):
+            fetch_btc_data()
+
+    @patch('yfinance.download')
+    def test_fetch_drops_duplicates_and_missing(self, mock_download, mock_history):
+        """Vérifie que les dates en double et les lignes incomplètes sont retirées."""
+        history = pd.concat([mock_history, mock_history.iloc[[-1]]])
+        history.iloc[0, history.columns.get_loc('Close')] = np.nan
+        mock_download.return_value = history
+
+        result = fetch_btc_data(days=30)
+
+        assert len(result) == 29
+        assert result['Date'].is_unique
+        assert not result.isnull().any().any()
+        assert list(result.index) == list(range(29))
+
+    @patch('yfinance.download')
+    def test_fetch_uses_fresh_cache(self, mock_download, mock_history):
+        """Vérifie qu'un second appel rapproché n'interroge pas yfinance."""
+        mock_download.return_value = mock_history
+
+        first = fetch_btc_data(days=30)
+        second = fetch_btc_data(days=30)
+
+        assert mock_download.call_count == 1
+        pd.testing.assert_frame_equal(first, second)
+
+    @patch('yfinance.download')
+    def test_fetch_ignores_expired_cache(self, mock_download, mock_history, isolated_cache):
+        """Vérifie qu'une entrée de cache expirée déclenche un nouvel appel."""
+        mock_download.return_value = mock_history
+        fetch_btc_data(days=30)
+
+        expired = time.time() - CACHE_TTL_SECONDS - 60
+        for path in isolated_cache.iterdir():
+            os.utime(path, (expired, expired))
+        fetch_btc_data(days=30)
+
+        assert mock_download.call_count == 2
+
+    @patch('yfinance.download')
+    def test_fetch_ignores_empty_cache_file(self, mock_download, mock_history, isolated_cache):
+        """Vérifie qu'un fichier de cache vide est ignoré (re-téléchargement)."""
+        mock_download.return_value = mock_history
+        fetch_btc_data(days=30)
+        for path in isolated_cache.iterdir():
+            path.write_text('')
+
+        result = fetch_btc_data(days=30)
+
+        assert mock_download.call_count == 2
+        assert len(result) == 30
+
+    @patch('yfinance.download')
+    def test_fetch_ignores_garbled_cache_file(self, mock_download, mock_history, isolated_cache):
+        """Vérifie qu'un fichier de cache corrompu est ignoré (re-téléchargement)."""
+        mock_download.return_value = mock_history
+        fetch_btc_data(days=30)
+        for path in isolated_cache.iterdir():
+            path.write_text('Date,Open\n2026-01-01,"40000\n\x00garbage')
+
+        result = fetch_btc_data(days=30)
+
+        assert mock_download.call_count == 2
+        assert len(result) == 30
+
+    @patch('yfinance.download')
+    def test_failed_cache_write_leaves_no_file(self, mock_download, mock_history, isolated_cache):
+        """Vérifie qu'une écriture interrompue ne laisse aucun fichier de cache."""
+        mock_download.return_value = mock_history
+
+        def partial_write(self, path, *args, **kwargs):
+            with open(path, 'w') as f:
+                f.write('Date,Open,High\n2026-01-01,40000')
+            raise OSError(28, 'No space left on device')
+
+        with patch.object(pd.DataFrame, 'to_csv', partial_write):
+            result = fetch_btc_data(days=30)
+
+        assert len(result) == 30
+        assert list(isolated_cache.iterdir()) == []
+
 
 # ============================================
 # Tests: prepare_features
@@ -173,6 +331,19 @@ class TestTrainModel:
         for key in expected_keys:
             assert key in metrics, f"Clé manquante: {key}"
 
+    def test_metrics_follow_decimals_by_key(self, prepared_data, monkeypatch):
+        """Vérifie que l'ordre de METRICS_DECIMALS n'affecte ni les valeurs ni l'arrondi."""
+        _, metrics, _, _, _, _ = train_model(prepared_data)
+
+        reordered = dict(reversed(list(etl_btc.METRICS_DECIMALS.items())))
+        reordered['coefficient'] = 1
+        monkeypatch.setattr('etl_btc.METRICS_DECIMALS', reordered)
+        _, reordered_metrics, _, _, _, _ = train_model(prepared_data)
+
+        for key, value in reordered_metrics.items():
+            assert value == pytest.approx(metrics[key], abs=10.0 ** -reordered[key])
+            assert value == round(value, reordered[key])
+
     def test_confidence_range(self, prepared_data):
         """Vérifie que la confiance est entre 0 et 1."""
         _, _, _, confidence, _, _ = train_model(prepared_data)
@@ -191,6 +362,67 @@ class TestTrainModel:
 
         assert prediction > 0
 
+    def test_matches_least_squares_fit(self, prepared_data):
+        """Vérifie que la forme fermée donne la même droite que np.polyfit."""
+        (slope, intercept), _, prediction, _, _, _ = train_model(prepared_data)
+
+        y = prepared_data['Close'].iloc[-TRAINING_WINDOW:].to_numpy()
+        expected_slope, expected_intercept = np.polyfit(np.arange(len(y)), y, 1)
+
+        assert slope == pytest.approx(expected_slope)
+        assert intercept == pytest.approx(expected_intercept)
+        assert prediction == pytest.approx(expected_intercept + expected_slope * len(y))
+
+    def test_residual_statistics(self, prepared_data):
+        """Vérifie les métriques dérivées des statistiques suffisantes."""
+        (slope, intercept), metrics, _, confidence, _, _ = train_model(prepared_data)
+
+        y = prepared_data['Close'].iloc[-TRAINING_WINDOW:].to_numpy()
+        residuals = y - (intercept + slope * np.arange(len(y)))
+        expected_r2 = 1 - (residuals ** 2).sum() / ((y - y.mean()) ** 2).sum()
+
+        assert metrics['std_error'] == pytest.approx(np.std(residuals), abs=0.01)
+        assert metrics['rmse'] == pytest.approx(np.sqrt((residuals ** 2).mean()), abs=0.01)
+        assert metrics['mae'] == pytest.approx(np.abs(residuals).mean(), abs=0.01)
+        assert confidence == pytest.approx(expected_r2)
+
+    def test_perfect_trend(self):
+        """Vérifie qu'une tendance parfaitement linéaire donne R² = 1 et un écart nul."""
+        prices = 40000.0 + 250.0 * np.arange(TRAINING_WINDOW)
+        df = pd.DataFrame({'Close': prices})
+
+        _, metrics, prediction, confidence, lower_bound, upper_bound = train_model(df)
+
+        assert metrics['std_error'] == pytest.approx(0.0, abs=0.01)
+        assert confidence == pytest.approx(1.0)
+        assert prediction == pytest.approx(40000.0 + 250.0 * TRAINING_WINDOW)
+        assert lower_bound == pytest.approx(upper_bound, abs=0.1)
+
+    def test_flat_prices_keep_precision(self):
+        """Vérifie R² sur des prix élevés quasi constants (pas d'annulation numérique)."""
+        np.random.seed(1)
+        y = 100000.0 + np.random.randn(TRAINING_WINDOW) * 0.5
+        df = pd.DataFrame({'Close': y})
+
+        _, _, _, confidence, _, _ = train_model(df)
+
+        # Régression simple: R² = carré de la corrélation (calculée sur données centrées)
+        expected_r2 = np.corrcoef(np.arange(len(y)), y)[0, 1] ** 2
+        assert confidence == pytest.approx(expected_r2, abs=1e-12)
+
+    def test_constant_prices(self):
+        """Vérifie que des prix constants ne produisent ni NaN ni avertissement."""
+        df = pd.DataFrame({'Close': [40000.0] * TRAINING_WINDOW})
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            _, metrics, prediction, confidence, _, _ = train_model(df)
+
+        assert confidence == 1.0
+        assert metrics['r2'] == 1.0
+        assert prediction == pytest.approx(40000.0)
+        assert metrics['std_error'] == 0.0
+
     def test_uses_training_window(self, prepared_data):
         """Vérifie que le modèle utilise TRAINING_WINDOW jours."""
         # Si on a plus de données que TRAINING_WINDOW, ça doit fonctionner
@@ -253,6 +485,142 @@ class TestUploadToSupabase:
 
         assert result is False
 
+    def test_upload_single_request(self, prepared_data):
+        """Vérifie que historique et prédiction partent en un seul upsert."""
+        mock_client = MagicMock()
+        mock_upsert = mock_client.table.return_value.upsert
+
+        upload_to_supabase(
+            client=mock_client,
+            df=prepared_data,
+            prediction=45000.0,
+            confidence=0.85,
+            lower_bound=44000.0,
+            upper_bound=46000.0
+        )
+
+        assert mock_upsert.call_count == 1
+        records = mock_upsert.call_args[0][0]
+        assert len(records) == len(prepared_data) + 1
+        assert mock_upsert.call_args[1]['on_conflict'] == 'date,symbol,model_version'
+
+    def test_upload_splits_large_payload_in_batches(self):
+        """Vérifie que les gros volumes sont découpés en lots, tous exécutés."""
+        dates = pd.date_range(end=datetime.now(), periods=2500, freq='D')
+        df = pd.DataFrame({'Date': dates.normalize(), 'Close': np.linspace(40000, 45000, 2500)})
+        mock_client = MagicMock()
+        mock_upsert = mock_client.table.return_value.upsert
+
+        result = upload_to_supabase(
+            client=mock_client,
+            df=df,
+            prediction=45000.0,
+            confidence=0.85,
+            lower_bound=44000.0,
+            upper_bound=46000.0
+        )
+
+        assert result is True
+        # 2500 lignes historiques + la prédiction
+        batch_sizes = [len(c[0][0]) for c in mock_upsert.call_args_list]
+        assert batch_sizes == [1000, 1000, 501]
+        assert mock_upsert.return_value.execute.call_count == 3
+
+    def test_historical_prices_rounded(self, prepared_data):
+        """Vérifie que les prix historiques sont arrondis au centime."""
+        mock_client = MagicMock()
+
+        upload_to_supabase(
+            client=mock_client,
+            df=prepared_data,
+            prediction=45000.0,
+            confidence=0.85,
+            lower_bound=44000.0,
+            upper_bound=46000.0
+        )
+
+        historical_records = mock_client.table.return_value.upsert.call_args_list[0][0][0][:-1]
+        assert len(historical_records) == len(prepared_data)
+        for record, close in zip(historical_records, prepared_data['Close']):
+            assert isinstance(record['actual_price'], float)
+            assert len(record['date']) == len('YYYY-MM-DD')
+            assert record['actual_price'] == round(close, 2)
+
+    @staticmethod
+    def _mock_stored_prices(mock_client, rows):
+        """Simule le SELECT des prix déjà en base."""
+        select_execute = (
+            mock_client.table.return_value.select.return_value
+            .eq.return_value.eq.return_value.gte.return_value
+            .not_.is_.return_value.execute
+        )
+        select_execute.return_value.data = rows
+
+    def test_skips_days_already_up_to_date(self, prepared_data):
+        """Vérifie que seuls les jours absents de la base sont renvoyés."""
+        mock_client = MagicMock()
+        dates = prepared_data['Date'].dt.strftime('%Y-%m-%d').tolist()
+        closes = prepared_data['Close'].round(2).tolist()
+        # Tous les jours sont en base avec le bon prix, sauf les deux derniers
+        self._mock_stored_prices(mock_client, [
+            {'date': d, 'actual_price': c} for d, c in zip(dates[:-2], closes[:-2])
+        ])
+
+        result = upload_to_supabase(
+            client=mock_client,
+            df=prepared_data,
+            prediction=45000.0,
+            confidence=0.85,
+            lower_bound=44000.0,
+            upper_bound=46000.0
+        )
+
+        assert result is True
+        records = mock_client.table.return_value.upsert.call_args[0][0]
+        # 2 jours manquants + la prédiction
+        assert [r['date'] for r in records[:-1]] == dates[-2:]
+        assert records[-1]['predicted_price'] == 45000.0
+
+    def test_resends_stale_previous_day(self, prepared_data):
+        """Vérifie qu'un prix partiel écrit au run précédent est remplacé par la clôture."""
+        mock_client = MagicMock()
+        dates = prepared_data['Date'].dt.strftime('%Y-%m-%d').tolist()
+        closes = prepared_data['Close'].round(2).tolist()
+        stored = [{'date': d, 'actual_price': c} for d, c in zip(dates, closes)]
+        # L'avant-dernier jour a été écrit en cours de journée (prix intraday)
+        stored[-2]['actual_price'] = closes[-2] - 123.45
+        self._mock_stored_prices(mock_client, stored)
+
+        upload_to_supabase(
+            client=mock_client,
+            df=prepared_data,
+            prediction=45000.0,
+            confidence=0.85,
+            lower_bound=44000.0,
+            upper_bound=46000.0
+        )
+
+        records = mock_client.table.return_value.upsert.call_args[0][0]
+        assert [r['date'] for r in records[:-1]] == [dates[-2]]
+        assert records[0]['actual_price'] == closes[-2]
+
+    def test_select_failure_returns_false(self, prepared_data):
+        """Vérifie qu'une erreur lors de la lecture des prix existants retourne False."""
+        mock_client = MagicMock()
+        mock_client.table.return_value.select.side_effect = Exception("DB Error")
+
+        result = upload_to_supabase(
+            client=mock_client,
+            df=prepared_data,
+            prediction=45000.0,
+            confidence=0.85,
+            lower_bound=44000.0,
+            upper_bound=46000.0
+        )
+
+        assert result is False
+        mock_client.table.return_value.upsert.assert_not_called()
+
     def test_prediction_record_format(self, prepared_data):
         """Vérifie le format de l'enregistrement de prédiction."""
         mock_client = MagicMock()
@@ -268,10 +636,10 @@ class TestUploadToSupabase:
             upper_bound=46000.0
         )
 
-        # Récupérer le dernier appel à upsert (la prédiction)
+        # La prédiction est le dernier enregistrement du dernier appel à upsert
         calls = mock_client.table.return_value.upsert.call_args_list
         last_call = calls[-1]
-        prediction_record = last_call[0][0]  # Premier argument positionnel
+        prediction_record = last_call[0][0][-1]  # Premier argument positionnel
 
         # Vérifier les champs
         assert prediction_record['predicted_price'] == 45000.0
@@ -298,7 +666,7 @@ class TestGetSupabaseClient:
                 result = get_supabase_client()
                 assert result is None
 
-    @patch('etl_btc.create_client')
+    @patch('supabase.create_client')
     def test_creates_client_with_valid_env(self, mock_create):
         """Vérifie que le client est créé avec des variables valides."""
         with patch('etl_btc.SUPABASE_URL', 'https://test.supabase.co'):